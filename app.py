@@ -1,19 +1,33 @@
 
 import os
+import hashlib
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import MappingProxyType
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 # from flask_wtf.csrf import CSRFProtect  # Disabled per user request
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import NullPool
 from werkzeug.middleware.proxy_fix import ProxyFix
-from credential_loader import load_credentials_from_json, get_credential
+from credential_loader import load_credentials_from_json
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (set LOG_LEVEL=DEBUG for verbose output)
+logging.basicConfig(level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+# SQLAlchemy would otherwise format a record for every statement at DEBUG
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
 
 # Load credentials from JSON file
 credentials = load_credentials_from_json()
+# JSON credentials take precedence over environment variables
+_CRED = MappingProxyType({**os.environ, **credentials})
 
 class Base(DeclarativeBase):
     pass
@@ -25,8 +39,12 @@ login_manager = LoginManager()
 
 # Create Flask app
 app = Flask(__name__)
+# API responses don't need sorted keys or indentation; skip the per-dict sort and pretty-printing
+app.json.sort_keys = False
+app.json.compact = True
+
 # Configure session secret key (required for Flask-Login)
-session_secret = get_credential(credentials,"SESSION_SECRET")
+session_secret = _CRED.get("SESSION_SECRET")
 if not session_secret:
     if app.debug or os.environ.get("FLASK_ENV") == "development":
         import os as _os
@@ -35,7 +53,11 @@ if not session_secret:
     else:
         raise SystemExit("❌ SESSION_SECRET environment variable is required in production")
 app.secret_key = session_secret
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+# Only trust X-Forwarded-* headers when a reverse proxy is in front of the app
+# (Replit/gunicorn deployments); local and exe runs can set BEHIND_PROXY=0
+# to skip the per-request header rewriting.
+if str(_CRED.get('BEHIND_PROXY', '1')).lower() in ('1', 'true'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Security configurations for production
 app.config['SESSION_COOKIE_SECURE'] = not app.debug
@@ -48,22 +70,62 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
 # Try MySQL first (from JSON credentials), then fallback to PostgreSQL
 mysql_config = {
-    'host': get_credential(credentials, 'MYSQL_HOST', 'localhost'),
-    'port': get_credential(credentials, 'MYSQL_PORT', '3306'),
-    'user': get_credential(credentials, 'MYSQL_USER', 'root'),
-    'password': get_credential(credentials, 'MYSQL_PASSWORD', 'root123'),
-    'database': get_credential(credentials, 'MYSQL_DATABASE', 'it_lobby')
+    'host': _CRED.get('MYSQL_HOST', 'localhost'),
+    'port': _CRED.get('MYSQL_PORT', '3306'),
+    'user': _CRED.get('MYSQL_USER', 'root'),
+    'password': _CRED.get('MYSQL_PASSWORD', 'root123'),
+    'database': _CRED.get('MYSQL_DATABASE', 'it_lobby')
+}
+
+# No pool_pre_ping: it costs a SELECT 1 round-trip on every checkout. Stale
+# connections are handled by pool_recycle, TCP keepalives (PostgreSQL) and the
+# throttled health check in _check_db_connection below.
+# LIFO checkout keeps a small hot set of connections busy so the rest can idle
+# out instead of every connection being cycled round-robin. Those idle tail
+# connections are why pool_recycle stays short: MySQL has no keepalive, and a
+# connection idle past a short wait_timeout must be recycled before it is reused.
+DB_ENGINE_OPTIONS = {
+    "pool_recycle": 300,
+    "pool_size": 25,
+    "max_overflow": 25,
+    "pool_use_lifo": True
+}
+POSTGRES_KEEPALIVE_ARGS = {
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 5
 }
+DB_HEALTH_CHECK_INTERVAL = 30  # seconds
+# Connections opened at boot, per process. Kept well below pool_size: every worker,
+# the reloader parent and CLI commands each warm their own pool. 0 disables warm-up.
+DB_POOL_WARM_SIZE = int(_CRED.get('DB_POOL_WARM_SIZE', 4))
+
+
+def _probe_database(url):
+    """Check connectivity with a single unpooled connection; the real pool is built by Flask-SQLAlchemy"""
+    engine = create_engine(url, poolclass=NullPool, connect_args={'connect_timeout': 5})
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    finally:
+        engine.dispose()
 
 # Check if we have a custom DATABASE_URL from JSON
-database_url_from_json = get_credential(credentials, 'DATABASE_URL')
+database_url_from_json = _CRED.get('DATABASE_URL')
+
+# The PostgreSQL fallback is probed alongside the primary database so a failed
+# primary doesn't add a second sequential connect timeout to startup
+fallback_database_url = os.environ.get('DATABASE_URL')
+fallback_probe = None
+_probe_executor = ThreadPoolExecutor(max_workers=2)
 
 try:
     if database_url_from_json:
         # Use DATABASE_URL from JSON credentials
         database_url = database_url_from_json
         logging.info(f"Using DATABASE_URL from JSON credentials")
-        db_type = "mysql" if "mysql" in database_url else "postgresql"
+        db_type = make_url(database_url).get_backend_name()
     elif mysql_config['host'] != 'localhost' or credentials:
         # Use MySQL configuration from JSON
         database_url = (
@@ -80,38 +142,27 @@ try:
         logging.info("Using PostgreSQL database (connection successful)")
         db_type = "postgresql"
 
-    from sqlalchemy import create_engine, text
-    test_engine = create_engine(database_url, connect_args={'connect_timeout': 5})
-    with test_engine.connect() as conn:
-        conn.execute(text("SELECT 1"))
+    if fallback_database_url and fallback_database_url != database_url:
+        fallback_probe = _probe_executor.submit(_probe_database, fallback_database_url)
+    _probe_executor.submit(_probe_database, database_url).result()
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-        "pool_recycle": 300,
-        "pool_pre_ping": True,
-        "pool_size": 10,
-        "max_overflow": 20
-    }
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(DB_ENGINE_OPTIONS)
     logging.info(f"✅ {db_type.upper()} database connection successful")
 
 except Exception as e:
     logging.error(f"❌ Database connection failed: {e}")
     # If MySQL from JSON fails, try PostgreSQL fallback
-    from sqlalchemy import create_engine, text
     try:
-        database_url = os.environ.get('DATABASE_URL')
+        database_url = fallback_database_url
         if database_url:
             logging.info("Trying PostgreSQL fallback...")
-            test_engine = create_engine(database_url, connect_args={'connect_timeout': 5})
-            with test_engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
+            if fallback_probe is not None:
+                fallback_probe.result()
+            else:
+                _probe_database(database_url)
             app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-            app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-                "pool_recycle": 300,
-                "pool_pre_ping": True,
-                "pool_size": 10,
-                "max_overflow": 20
-            }
+            app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(DB_ENGINE_OPTIONS)
             db_type = "postgresql"
             logging.info("✅ PostgreSQL fallback connection successful")
         else:
@@ -119,9 +170,14 @@ except Exception as e:
     except Exception as fallback_error:
         logging.error(f"❌ PostgreSQL fallback also failed: {fallback_error}")
         raise SystemExit("Database connection failed. Please check database settings.")
+finally:
+    # Don't block startup on a fallback probe that is no longer needed
+    _probe_executor.shutdown(wait=False)
 
 # Store database type
 app.config["DB_TYPE"] = db_type
+if db_type == "postgresql":
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = dict(POSTGRES_KEEPALIVE_ARGS)
 
 # Initialize extensions
 db.init_app(app)
@@ -129,6 +185,47 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'  # type: ignore
 login_manager.login_message = 'Please log in to access this page.'
 
+_last_db_check = 0.0
+
+
+@app.before_request
+def _check_db_connection():
+    """Ping the database at most once per DB_HEALTH_CHECK_INTERVAL instead of on every pool checkout"""
+    global _last_db_check
+    now = time.monotonic()
+    if now - _last_db_check < DB_HEALTH_CHECK_INTERVAL:
+        return
+    _last_db_check = now
+    try:
+        db.session.execute(text("SELECT 1"))
+    except Exception as e:
+        # A disconnect error invalidates the pool, so stale connections are replaced on next checkout
+        logging.warning(f"⚠️ Database health check failed: {e}")
+        db.session.rollback()
+
+
+def _warm_connection_pool(engine, size):
+    """Open `size` pooled connections concurrently so the first requests after boot don't pay the connect cost"""
+    if size <= 0:
+        return
+    def _checkout(_):
+        conn = engine.connect()
+        conn.execute(text("SELECT 1"))
+        return conn
+
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        futures = [executor.submit(_checkout, i) for i in range(size)]
+    connections = []
+    for future in futures:
+        try:
+            connections.append(future.result())
+        except Exception as e:
+            logging.warning(f"⚠️ Connection pool warm-up failed: {e}")
+    # Returning the connections leaves them idle in the pool
+    for conn in connections:
+        conn.close()
+    logging.info(f"✅ Connection pool warmed with {len(connections)} connections")
+
 # CSRF protection disabled per user request
 # csrf = CSRFProtect(app)
 
@@ -146,43 +243,125 @@ login_manager.login_message = 'Please log in to access this page.'
 #     return e
 
 # SAP B1 Configuration (from JSON credentials)
-app.config['SAP_B1_SERVER'] = get_credential(credentials, 'SAP_B1_SERVER', 'https://10.112.253.173:50000')
-app.config['SAP_B1_USERNAME'] = get_credential(credentials, 'SAP_B1_USERNAME', 'manager')
-app.config['SAP_B1_PASSWORD'] = get_credential(credentials, 'SAP_B1_PASSWORD', '1422')
-app.config['SAP_B1_COMPANY_DB'] = get_credential(credentials, 'SAP_B1_COMPANY_DB', 'SBODemoUS')
+app.config['SAP_B1_SERVER'] = _CRED.get('SAP_B1_SERVER', 'https://10.112.253.173:50000')
+app.config['SAP_B1_USERNAME'] = _CRED.get('SAP_B1_USERNAME', 'manager')
+app.config['SAP_B1_PASSWORD'] = _CRED.get('SAP_B1_PASSWORD', '1422')
+app.config['SAP_B1_COMPANY_DB'] = _CRED.get('SAP_B1_COMPANY_DB', 'SBODemoUS')
 
 # Log SAP B1 configuration (without password)
 logging.info(f"SAP B1 Server: {app.config['SAP_B1_SERVER']}")
 logging.info(f"SAP B1 Username: {app.config['SAP_B1_USERNAME']}")
 logging.info(f"SAP B1 Company DB: {app.config['SAP_B1_COMPANY_DB']}")
 
-# Import models
-import models
-import models_extensions
-from modules.invoice_creation import models as invoice_models  # noqa: F401
+
+def _insert_if_absent(model, values):
+    """INSERT a row, skipping it if its primary/unique key already exists.
+
+    On MySQL this is ON DUPLICATE KEY UPDATE with a no-op assignment rather than
+    INSERT IGNORE, which would also downgrade truncation and NOT NULL errors to
+    warnings. MySQL reports a skipped duplicate as a matched row, so rowcount only
+    tells an insert from a skip on PostgreSQL.
+    """
+    if app.config["DB_TYPE"] == "mysql":
+        stmt = mysql_insert(model).values(values).on_duplicate_key_update(id=model.id)
+    else:
+        stmt = pg_insert(model).values(values).on_conflict_do_nothing()
+    return db.session.execute(stmt)
+
+
+def _load_models():
+    """Import model modules so their tables are registered before create_all()"""
+    import models  # noqa: F401
+    import models_extensions  # noqa: F401
+    from modules.invoice_creation import models as invoice_models  # noqa: F401
+
 
 with app.app_context():
-    # Create all tables first to ensure they exist before any queries
+    _load_models()
+    _warm_connection_pool(db.engine, min(DB_POOL_WARM_SIZE, app.config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"]))
+
+# Setup logging
+try:
+    from logging_config import setup_logging
+    logger = setup_logging(app)
+    logger.info("🚀 WMS Application starting with file-based logging")
+except Exception as e:
+    logging.warning(f"⚠️ Logging setup failed: {e}. Using basic logging.")
+
+# Register all modules through main controller
+from modules import main_controller
+main_controller.register_modules(app)
+
+
+def init_database():
+    """Create missing tables, drop legacy constraints and seed default data"""
+    # All core and module models are registered by now, so one create_all covers them
     db.create_all()
     logging.info("✅ Database tables created")
 
-    # Drop unique constraint if exists (PostgreSQL version)
+    # Drop unique constraint if exists (PostgreSQL version).
+    # The model no longer defines it, so once the check has passed a sentinel
+    # file lets later boots skip the information_schema query. The sentinel is
+    # per database, so a later fallback to a different PostgreSQL still checks.
+    database_key = hashlib.sha1(
+        db.engine.url.render_as_string(hide_password=True).encode()
+    ).hexdigest()[:12]
+    constraint_sentinel = (Path(__file__).resolve().parent / '.migrations'
+                           / f'unique_serial_per_item.{database_key}.dropped')
+    if app.config["DB_TYPE"] == "postgresql" and not constraint_sentinel.exists():
+        try:
+            with db.engine.connect() as conn:
+                result = conn.execute(text("""
+                    SELECT constraint_name 
+                    FROM information_schema.table_constraints 
+                    WHERE table_schema = 'public' 
+                    AND table_name = 'serial_number_transfer_serials' 
+                    AND constraint_name = 'unique_serial_per_item'
+                """))
+                if result.fetchone():
+                    conn.execute(text("ALTER TABLE serial_number_transfer_serials DROP CONSTRAINT unique_serial_per_item"))
+                    conn.commit()
+                    logging.info("Dropped unique_serial_per_item constraint")
+            constraint_sentinel.parent.mkdir(parents=True, exist_ok=True)
+            constraint_sentinel.touch()
+        except Exception as e:
+            logging.warning(f"⚠️ Could not drop unique constraint: {e}")
+
+    # Keyset pagination index for the SO Against Invoice list. create_all only adds it
+    # to new tables, so existing ones get it here.
     try:
-        from sqlalchemy import text
-        with db.engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT constraint_name 
-                FROM information_schema.table_constraints 
-                WHERE table_schema = 'public' 
-                AND table_name = 'serial_number_transfer_serials' 
-                AND constraint_name = 'unique_serial_per_item'
-            """))
-            if result.fetchone():
-                conn.execute(text("ALTER TABLE serial_number_transfer_serials DROP CONSTRAINT unique_serial_per_item"))
-                conn.commit()
-                logging.info("Dropped unique_serial_per_item constraint")
+        with db.engine.begin() as conn:
+            if app.config["DB_TYPE"] == "postgresql":
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_soinv_created_id ON so_invoice_documents (created_at, id)"
+                ))
+            else:
+                index_exists = conn.execute(text("""
+                    SELECT 1
+                    FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE()
+                    AND TABLE_NAME = 'so_invoice_documents'
+                    AND INDEX_NAME = 'ix_soinv_created_id'
+                    LIMIT 1
+                """)).first()
+                if not index_exists:
+                    conn.execute(text("CREATE INDEX ix_soinv_created_id ON so_invoice_documents (created_at, id)"))
+                    logging.info("✅ Created ix_soinv_created_id index")
     except Exception as e:
-        logging.warning(f"⚠️ Could not drop unique constraint: {e}")
+        logging.warning(f"⚠️ Could not create SO pagination index: {e}")
+
+    # Trigram index behind the SO Against Invoice search box (PostgreSQL only)
+    if app.config["DB_TYPE"] == "postgresql":
+        try:
+            from modules.so_against_invoice.models import SO_SEARCH_EXPRESSION
+            with db.engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_soinv_search ON so_invoice_documents "
+                    f"USING gin (({SO_SEARCH_EXPRESSION}) gin_trgm_ops)"
+                ))
+        except Exception as e:
+            logging.warning(f"⚠️ Could not create SO search index: {e}")
 
     # Create default data
     try:
@@ -190,42 +369,46 @@ with app.app_context():
         from werkzeug.security import generate_password_hash
         from models import User
 
-        default_branch = Branch.query.filter_by(id='BR001').first()
-        if not default_branch:
-            default_branch = Branch()
-            default_branch.id = 'BR001'
-            default_branch.name = 'Main Branch'
-            default_branch.branch_code = 'BR001'
-            default_branch.branch_name = 'Main Branch'
-            default_branch.description = 'Main Office Branch'
-            default_branch.address = 'Main Office'
-            default_branch.phone = '123-456-7890'
-            default_branch.email = 'main@company.com'
-            default_branch.manager_name = 'Branch Manager'
-            default_branch.active = True
-            default_branch.is_default = True
-            db.session.add(default_branch)
-            logging.info("✅ Default branch created")
-
-        # Only create admin user in development or if explicitly requested
+        # Idempotent insert: a no-op once the branch exists, so no SELECT is needed first
+        _insert_if_absent(Branch, {
+            'id': 'BR001',
+            'name': 'Main Branch',
+            'branch_code': 'BR001',
+            'branch_name': 'Main Branch',
+            'description': 'Main Office Branch',
+            'address': 'Main Office',
+            'phone': '123-456-7890',
+            'email': 'main@company.com',
+            'manager_name': 'Branch Manager',
+            'active': True,
+            'is_default': True,
+        })
+        logging.info("✅ Default branch ensured")
+
+        # Only create admin user in development or if explicitly requested.
+        # The existence check stays here: an unconditional insert would hash the
+        # default password on every boot, which costs more than the SELECT.
         if os.environ.get('CREATE_DEFAULT_ADMIN') == 'true' or app.debug:
-            admin = User.query.filter_by(username='admin').first()
-            if not admin:
+            admin_exists = db.session.query(User.id).filter_by(username='admin').first()
+            if not admin_exists:
                 default_password = os.environ.get('ADMIN_PASSWORD', 'admin123')
-                admin = User()
-                admin.username = 'admin'
-                admin.email = 'admin@company.com'
-                admin.password_hash = generate_password_hash(default_password)
-                admin.first_name = 'System'
-                admin.last_name = 'Administrator'
-                admin.role = 'admin'
-                admin.branch_id = 'BR001'
-                admin.branch_name = 'Main Branch'
-                admin.default_branch_id = 'BR001'
-                admin.active = True
-                admin.must_change_password = True  # Force password change
-                db.session.add(admin)
-                logging.info("✅ Default admin user created (password change required)")
+                # Same idempotent insert as the branch, so two workers booting together
+                # can't fail the whole seeding transaction on the unique username
+                result = _insert_if_absent(User, {
+                    'username': 'admin',
+                    'email': 'admin@company.com',
+                    'password_hash': generate_password_hash(default_password),
+                    'first_name': 'System',
+                    'last_name': 'Administrator',
+                    'role': 'admin',
+                    'branch_id': 'BR001',
+                    'branch_name': 'Main Branch',
+                    'default_branch_id': 'BR001',
+                    'active': True,
+                    'must_change_password': True,  # Force password change
+                })
+                if result.rowcount:
+                    logging.info("✅ Default admin user created (password change required)")
 
         db.session.commit()
         logging.info("✅ Default data initialized")
@@ -234,22 +417,24 @@ with app.app_context():
         logging.error(f"❌ Error initializing default data: {e}")
         db.session.rollback()
 
-# Setup logging
-try:
-    from logging_config import setup_logging
-    logger = setup_logging(app)
-    logger.info("🚀 WMS Application starting with file-based logging")
-except Exception as e:
-    logging.warning(f"⚠️ Logging setup failed: {e}. Using basic logging.")
 
-# Register all modules through main controller
-from modules import main_controller
-main_controller.register_modules(app)
+@app.cli.command('db-init')
+def db_init_command():
+    """Create database tables and default data (run once per deploy)"""
+    # Importing the app already ran init_database() unless RUN_MIGRATIONS=0
+    if _startup_init_done:
+        logging.info("✅ Database already initialized during app import")
+        return
+    init_database()
 
-# Database tables already created above, this ensures module models are included
-with app.app_context():
-    db.create_all()  # Safe to call again, will only create missing tables
-    logging.info("✅ All module models verified/created")
+
+# create_all issues a metadata query per table, so deployments that run
+# `flask --app main db-init` during deploy can set RUN_MIGRATIONS=0 to skip it
+# on every worker start. Local/exe runs keep initializing on startup.
+_startup_init_done = os.environ.get('RUN_MIGRATIONS', '1') == '1'
+if _startup_init_done:
+    with app.app_context():
+        init_database()
 
 # Import routes
 import routes
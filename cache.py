@@ -0,0 +1,60 @@
+"""
+In-process TTL cache for SAP B1 lookups
+Cache-aside helpers shared by the module routes. Entries live per worker
+process and expire after their TTL; expired entries are purged on write and
+the store is capped at MAX_ENTRIES, evicting the least recently used.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = 2048
+PURGE_INTERVAL = 60  # seconds between full sweeps for expired entries
+
+_store = OrderedDict()
+_lock = threading.Lock()
+_next_purge = 0.0
+
+
+def _make_room(now):
+    """Drop expired entries (at most every PURGE_INTERVAL) and evict LRU entries over MAX_ENTRIES.
+
+    Caller must hold _lock.
+    """
+    global _next_purge
+    if now >= _next_purge:
+        for key in [key for key, (expires_at, _) in _store.items() if expires_at < now]:
+            del _store[key]
+        _next_purge = now + PURGE_INTERVAL
+    while len(_store) >= MAX_ENTRIES:
+        _store.popitem(last=False)
+
+
+def get(key):
+    """Return the cached value for key, or None if missing/expired"""
+    with _lock:
+        entry = _store.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del _store[key]
+            return None
+        _store.move_to_end(key)
+        return value
+
+
+def put(key, value, ttl):
+    """Cache value under key for ttl seconds"""
+    with _lock:
+        now = time.monotonic()
+        _store.pop(key, None)
+        _make_room(now)
+        _store[key] = (now + ttl, value)
+
+
+def delete(*keys):
+    """Remove keys from the cache (missing keys are ignored)"""
+    with _lock:
+        for key in keys:
+            _store.pop(key, None)
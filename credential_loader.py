@@ -2,9 +2,13 @@ import json
 import os
 import logging
 
+# Parsed credential files keyed by path: {file_path: (st_mtime, credentials)}
+_cache = {}
+
 def load_credentials_from_json(file_path=None):
     """
     Load credentials from JSON file.
+    The parsed result is cached and only re-read when the file's mtime changes.
     
     Args:
         file_path (str): Path to JSON credential file. 
@@ -21,8 +25,13 @@ def load_credentials_from_json(file_path=None):
     
     try:
         if os.path.exists(file_path):
+            mtime = os.stat(file_path).st_mtime
+            cached = _cache.get(file_path)
+            if cached and cached[0] == mtime:
+                return cached[1]
             with open(file_path, 'r') as f:
                 credentials = json.load(f)
+            _cache[file_path] = (mtime, credentials)
             logging.info(f"✅ Credentials loaded from {file_path}")
             return credentials
         else:
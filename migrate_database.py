@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Serial Item Transfer Enhancement Migration
+
+Brings an existing MySQL `serial_item_transfer_items` table up to date with the
+SerialItemTransferItem model:
+1. Adds the workflow metadata columns (is_serial_managed, item_type, quantities, ...)
+2. Makes serial_number nullable for non-serial line items (same ALTER as step 1)
+3. Backfills the new columns for existing rows
+4. Adds lookup indexes on the new columns
+
+Run: python migrate_database.py [--auto]
+"""
+
+import sys
+import logging
+import logging.handlers
+import pymysql
+
+from credential_loader import load_credentials_from_json, get_credential
+
+# Configure logging
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# The MemoryHandler only buffers; the formatter has to sit on the FileHandler it flushes to
+_file_handler = logging.FileHandler('migrate_database.log', encoding='utf-8')
+_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=LOG_FORMAT,
+    handlers=[
+        logging.StreamHandler(),
+        # Buffer file writes; flushed every 256 records, on ERROR and at exit
+        logging.handlers.MemoryHandler(
+            capacity=256,
+            flushLevel=logging.ERROR,
+            target=_file_handler
+        )
+    ]
+)
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = 'serial_item_transfer_items'
+
+# Columns required by models.SerialItemTransferItem
+COLUMNS_TO_ADD = [
+    ('is_serial_managed', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('is_batch_managed', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('item_type', "VARCHAR(20) DEFAULT 'serial'"),
+    ('expected_quantity', 'INT NOT NULL DEFAULT 1'),
+    ('scanned_quantity', 'INT NOT NULL DEFAULT 0'),
+    ('completion_status', "VARCHAR(20) DEFAULT 'pending'"),
+    ('parent_item_code', 'VARCHAR(50) NULL'),
+    ('line_group_id', 'VARCHAR(50) NULL'),
+]
+
+INDEXES_TO_ADD = [
+    ('idx_serial_items_is_serial_managed', 'is_serial_managed'),
+    ('idx_serial_items_completion_status', 'completion_status'),
+    ('idx_serial_items_item_type', 'item_type'),
+    ('idx_serial_items_parent_item_code', 'parent_item_code'),
+]
+
+# Advisory lock name; a second runner gives up instead of racing the same DDL
+MIGRATION_LOCK_NAME = 'migrate_sit_enhancement'
+
+# SQL is built once at import; methods only bind parameters or append clauses
+_SQL_ALTER_TABLE = f"ALTER TABLE {TABLE_NAME} "
+
+# ALTER TABLE clause templates, joined into one statement per phase
+_SQL_ADD_COLUMN = "ADD COLUMN {if_not_exists}{name} {ddl}"
+_SQL_ADD_INDEX = "ADD INDEX {if_not_exists}{name} ({column})"
+_SQL_SERIAL_NUMBER_NULLABLE = "MODIFY COLUMN serial_number VARCHAR(100) NULL"
+_SQL_IF_NOT_EXISTS = "IF NOT EXISTS "
+
+# Tried in order until the server accepts one: metadata-only, online rebuild, server default.
+# (MySQL only allows LOCK=DEFAULT together with ALGORITHM=INSTANT.)
+_ALTER_ALGORITHMS = [
+    ('INSTANT', ', ALGORITHM=INSTANT'),
+    ('INPLACE', ', ALGORITHM=INPLACE, LOCK=NONE'),
+    ('DEFAULT', ''),
+]
+
+# Secondary indexes can't be added instantly; build them online or fall back to the default
+_INDEX_ALTER_ALGORITHMS = _ALTER_ALGORITHMS[1:]
+
+# Errors meaning "this algorithm can't do that here". MySQL 5.7 and older MariaDB
+# reject ALGORITHM=INSTANT as an unknown algorithm (1800); 1064 covers servers
+# that don't parse the ALGORITHM/LOCK clause at all.
+_ER_PARSE_ERROR = 1064
+_ER_UNKNOWN_ALTER_ALGORITHM = 1800
+_ER_ALTER_OPERATION_NOT_SUPPORTED = 1845
+_ER_ALTER_OPERATION_NOT_SUPPORTED_REASON = 1846
+_ALGORITHM_UNSUPPORTED_ERRORS = {
+    _ER_PARSE_ERROR,
+    _ER_UNKNOWN_ALTER_ALGORITHM,
+    _ER_ALTER_OPERATION_NOT_SUPPORTED,
+    _ER_ALTER_OPERATION_NOT_SUPPORTED_REASON,
+}
+
+# Only the enhancement columns; the server filters, so just their names come back
+_SQL_PRESENT_COLUMNS = f"""
+    SELECT COLUMN_NAME
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+      AND COLUMN_NAME IN ({", ".join(["%s"] * len(COLUMNS_TO_ADD))})
+"""
+
+# Columns and indexes in one round-trip before any DDL; the column ALTER and the
+# backfill don't touch indexes, so the index half is still valid for create_indexes
+_SQL_SCHEMA_SNAPSHOT = """
+    SELECT 'column', COLUMN_NAME, IS_NULLABLE
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    UNION ALL
+    SELECT DISTINCT 'index', INDEX_NAME, NULL
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+"""
+
+# Primary keys per backfill transaction
+BACKFILL_BATCH_SIZE = 10000
+
+_SQL_ID_RANGE = f"SELECT MIN(id), MAX(id) FROM {TABLE_NAME}"
+
+# One pass per id range; CASE picks the serial / non-serial values per row.
+# Rows already backfilled ('completed') are skipped, so re-runs don't rewrite them.
+_SQL_UPDATE_BACKFILL = f"""
+    UPDATE {TABLE_NAME}
+    SET is_serial_managed = (serial_number IS NOT NULL AND serial_number <> ''),
+        item_type = CASE WHEN serial_number IS NOT NULL AND serial_number <> '' THEN 'serial' ELSE 'non_serial' END,
+        expected_quantity = CASE WHEN serial_number IS NOT NULL AND serial_number <> '' THEN 1 ELSE COALESCE(quantity, 1) END,
+        scanned_quantity = CASE WHEN serial_number IS NOT NULL AND serial_number <> '' THEN 1 ELSE COALESCE(quantity, 1) END,
+        completion_status = 'completed'
+    WHERE id BETWEEN %s AND %s
+      AND (completion_status IS NULL OR completion_status = 'pending')
+"""
+
+# Approximate InnoDB row count from table statistics; avoids a full scan just for a log line
+_SQL_TABLE_ROWS = """
+    SELECT TABLE_ROWS
+    FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+"""
+
+# Per-row FK / unique-index probes are skipped during the backfill and DDL; the
+# rows written are derived from data already in the table
+_SQL_SESSION_CHECKS = "SELECT @@SESSION.unique_checks, @@SESSION.foreign_key_checks"
+_SQL_SET_SESSION_CHECKS = "SET SESSION unique_checks = %s, SESSION foreign_key_checks = %s"
+
+_SQL_VERSION = "SELECT VERSION()"
+_SQL_GET_LOCK = "SELECT GET_LOCK(%s, 0)"
+_SQL_RELEASE_LOCK = "SELECT RELEASE_LOCK(%s)"
+
+# Upper bound on breakdown rows written to the log
+BREAKDOWN_ROW_LIMIT = 1000
+
+_SQL_BREAKDOWN = f"""
+    SELECT item_type, is_serial_managed, completion_status, COUNT(*) AS count
+    FROM {TABLE_NAME}
+    GROUP BY item_type, is_serial_managed, completion_status
+    LIMIT {BREAKDOWN_ROW_LIMIT}
+"""
+
+
+class SerialItemTransferMigration:
+    def __init__(self):
+        self.connection = None
+        self.cursor = None
+        self._creds = None
+        self.is_mariadb = False
+
+    def load_credentials(self):
+        """Get MySQL configuration from the JSON credential file or environment (resolved once per run)"""
+        if self._creds is not None:
+            return self._creds
+        credentials = load_credentials_from_json()
+        self._creds = {
+            'host': get_credential(credentials, 'MYSQL_HOST', 'localhost'),
+            'port': int(get_credential(credentials, 'MYSQL_PORT', '3306')),
+            'user': get_credential(credentials, 'MYSQL_USER', 'root'),
+            'password': get_credential(credentials, 'MYSQL_PASSWORD', ''),
+            'database': get_credential(credentials, 'MYSQL_DATABASE', 'it_lobby'),
+        }
+        return self._creds
+
+    def connect_database(self):
+        """Connect to MySQL database"""
+        config = self.load_credentials()
+        try:
+            self.connection = pymysql.connect(
+                host=config['host'],
+                port=config['port'],
+                user=config['user'],
+                password=config['password'],
+                database=config['database'],
+                charset='utf8mb4',
+                autocommit=False
+            )
+            self.cursor = self.connection.cursor()
+            self.cursor.execute(_SQL_VERSION)
+            self.is_mariadb = 'MariaDB' in self.cursor.fetchone()[0]
+            logger.info("✅ Connected to MySQL: %s at %s:%s", config['database'], config['host'], config['port'])
+            return True
+        except Exception as e:
+            logger.error("❌ MySQL connection failed: %s", e)
+            return False
+
+    def get_existing_schema(self):
+        """Return ({column_name: IS_NULLABLE}, {index_name}) for the table from one query"""
+        self.cursor.execute(_SQL_SCHEMA_SNAPSHOT, (TABLE_NAME, TABLE_NAME))
+        columns, indexes = {}, set()
+        for kind, name, is_nullable in self.cursor.fetchall():
+            if kind == 'column':
+                columns[name] = is_nullable
+            else:
+                indexes.add(name)
+        return columns, indexes
+
+    def alter_table(self, clauses, algorithms=_ALTER_ALGORITHMS):
+        """Run one ALTER TABLE with the given clauses, using the cheapest algorithm the server accepts"""
+        alter_sql = _SQL_ALTER_TABLE + ", ".join(clauses)
+        for name, suffix in algorithms:
+            try:
+                self.cursor.execute(alter_sql + suffix)
+                logger.info("✅ ALTER TABLE completed with ALGORITHM=%s", name)
+                return name
+            except pymysql.err.MySQLError as e:
+                if e.args[0] not in _ALGORITHM_UNSUPPORTED_ERRORS or not suffix:
+                    raise
+                logger.info("ℹ️ ALGORITHM=%s not supported here (%s); trying next", name, e.args[1])
+
+    def add_missing_columns(self, existing):
+        """Add missing enhancement columns and make serial_number nullable in one ALTER TABLE"""
+        logger.info("🔍 Checking for missing columns...")
+        columns_needed = [(name, ddl) for name, ddl in COLUMNS_TO_ADD if name not in existing]
+
+        # MariaDB can re-check existence atomically inside the ALTER itself
+        if_not_exists = _SQL_IF_NOT_EXISTS if self.is_mariadb else ""
+        clauses = [_SQL_ADD_COLUMN.format(if_not_exists=if_not_exists, name=name, ddl=ddl)
+                   for name, ddl in columns_needed]
+        # Non-serial items are stored without a serial number
+        if existing.get('serial_number') != 'YES':
+            clauses.append(_SQL_SERIAL_NUMBER_NULLABLE)
+
+        if not clauses:
+            logger.info("ℹ️ All enhancement columns already exist")
+            return
+
+        # One statement takes the metadata lock once and plans a single rebuild at most
+        self.alter_table(clauses)
+
+        if columns_needed:
+            logger.info("✅ Added columns: %s", ", ".join(name for name, _ in columns_needed))
+        if existing.get('serial_number') != 'YES':
+            logger.info("✅ serial_number column is now nullable")
+
+    def update_existing_data(self):
+        """Backfill the new columns for rows created before the enhancement.
+
+        Walks the primary key in BACKFILL_BATCH_SIZE ranges and commits each one, so
+        no single transaction holds row locks or undo for the whole table.
+        """
+        logger.info("🔄 Updating existing line items...")
+
+        self.cursor.execute(_SQL_ID_RANGE)
+        min_id, max_id = self.cursor.fetchone()
+        if min_id is None:
+            logger.info("ℹ️ No line items to update")
+            return
+
+        updated = 0
+        for start_id in range(min_id, max_id + 1, BACKFILL_BATCH_SIZE):
+            end_id = start_id + BACKFILL_BATCH_SIZE - 1
+            self.cursor.execute(_SQL_UPDATE_BACKFILL, (start_id, end_id))
+            self.connection.commit()
+            updated += self.cursor.rowcount
+            logger.debug("   ... ids %s-%s: %s line items updated so far", start_id, min(end_id, max_id), updated)
+
+        logger.info("✅ Updated %s line items", updated)
+
+    def create_indexes(self, existing):
+        """Create missing lookup indexes on the enhancement columns in one ALTER TABLE"""
+        logger.info("📇 Creating indexes...")
+        missing = [(name, column) for name, column in INDEXES_TO_ADD if name not in existing]
+
+        if not missing:
+            logger.info("ℹ️ All indexes already exist")
+            return
+
+        # InnoDB builds all secondary indexes of one ALTER in a single scan of the clustered index
+        if_not_exists = _SQL_IF_NOT_EXISTS if self.is_mariadb else ""
+        self.alter_table(
+            [_SQL_ADD_INDEX.format(if_not_exists=if_not_exists, name=name, column=column)
+             for name, column in missing],
+            algorithms=_INDEX_ALTER_ALGORITHMS
+        )
+        logger.info("✅ Created indexes: %s", ", ".join(name for name, _ in missing))
+
+    def verify_migration(self):
+        """Verify all required columns exist and log a summary of the migrated rows"""
+        logger.info("🔍 Verifying migration...")
+        self.cursor.execute(_SQL_PRESENT_COLUMNS, (TABLE_NAME, *(name for name, _ in COLUMNS_TO_ADD)))
+        present = {column_name for (column_name,) in self.cursor.fetchall()}
+        if len(present) < len(COLUMNS_TO_ADD):
+            missing_columns = [name for name, _ in COLUMNS_TO_ADD if name not in present]
+            logger.error("❌ Missing columns after migration: %s", ", ".join(missing_columns))
+            return False
+
+        self.cursor.execute(_SQL_TABLE_ROWS, (TABLE_NAME,))
+        logger.info("📋 %s: ~%s records", TABLE_NAME, self.cursor.fetchone()[0])
+
+        # Unbuffered cursor: each group is logged as it arrives instead of after fetchall()
+        with self.connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(_SQL_BREAKDOWN)
+            for item_type, is_serial_managed, completion_status, count in cursor:
+                logger.info("   - %s / serial_managed=%s / %s: %s",
+                            item_type, is_serial_managed, completion_status, count)
+
+        logger.info("✅ Migration verified")
+        return True
+
+    def run_migration(self):
+        """Run the complete migration process"""
+        logger.info("🚀 Starting Serial Item Transfer enhancement migration")
+        logger.info("=" * 70)
+
+        if not self.connect_database():
+            logger.error("❌ Migration failed: Could not connect to database")
+            return False
+
+        self.cursor.execute(_SQL_GET_LOCK, (MIGRATION_LOCK_NAME,))
+        if not self.cursor.fetchone()[0]:
+            logger.error("❌ Another migration run holds the migration lock; aborting")
+            self.connection.close()
+            return False
+
+        session_checks = None
+        try:
+            self.cursor.execute(_SQL_SESSION_CHECKS)
+            session_checks = self.cursor.fetchone()
+            self.cursor.execute(_SQL_SET_SESSION_CHECKS, (0, 0))
+
+            existing_columns, existing_indexes = self.get_existing_schema()
+            self.add_missing_columns(existing_columns)
+            self.update_existing_data()
+            self.create_indexes(existing_indexes)
+            self.connection.commit()
+
+            if not self.verify_migration():
+                return False
+
+            logger.info("=" * 70)
+            logger.info("🎉 SERIAL ITEM TRANSFER MIGRATION COMPLETED SUCCESSFULLY!")
+            logger.info("=" * 70)
+            return True
+
+        except Exception as e:
+            logger.error("❌ Migration failed: %s", e)
+            self.connection.rollback()
+            return False
+
+        finally:
+            if self.connection:
+                try:
+                    if session_checks:
+                        self.cursor.execute(_SQL_SET_SESSION_CHECKS, session_checks)
+                    self.cursor.execute(_SQL_RELEASE_LOCK, (MIGRATION_LOCK_NAME,))
+                except pymysql.err.MySQLError as e:
+                    logger.warning("⚠️ Could not restore session state: %s", e)
+                self.connection.close()
+                logger.info("🔐 Database connection closed")
+
+
+def main():
+    """Main entry point"""
+    print("🚀 Serial Item Transfer Enhancement Migration")
+    print("=" * 70)
+
+    # Confirm before running
+    if len(sys.argv) > 1 and sys.argv[1] == '--auto':
+        confirm = 'yes'
+    else:
+        confirm = input("Do you want to run this migration? (y/N): ")
+
+    if confirm.lower() in ['y', 'yes']:
+        migration = SerialItemTransferMigration()
+        if migration.run_migration():
+            print("\n✅ Migration completed successfully!")
+        else:
+            print("\n❌ Migration failed!")
+            sys.exit(1)
+    else:
+        print("Migration cancelled.")
+
+
+if __name__ == '__main__':
+    main()
@@ -622,29 +622,35 @@ class DocumentNumberSeries(db.Model):
     @classmethod
     def get_next_number(cls, document_type):
         """Generate next document number for given document type"""
-        series = cls.query.filter_by(document_type=document_type).first()
+        # Increment in the database so concurrent callers can't read the same
+        # counter; the row lock is held only until the commit below
+        updated = cls.query.filter_by(document_type=document_type).update(
+            {cls.current_number: cls.current_number + 1, cls.updated_at: datetime.utcnow()},
+            synchronize_session=False
+        )
         
-        if not series:
-            # Create default series if not exists
+        if not updated:
+            # Create default series if not exists (number 1 is claimed by this call)
             prefixes = {
                 'GRPO': 'GRPO-',
                 'TRANSFER': 'TR-',
                 'PICKLIST': 'PL-'
             }
-            series = cls(
+            db.session.add(cls(
                 document_type=document_type,
                 prefix=prefixes.get(document_type, 'DOC-'),
-                current_number=1
-            )
-            db.session.add(series)
+                current_number=2
+            ))
+        
+        # Column query reads the row as updated above, never a stale identity-map copy
+        prefix, next_number, use_year_suffix = db.session.query(
+            cls.prefix, cls.current_number, cls.year_suffix
+        ).filter_by(document_type=document_type).one()
         
         # Generate document number
-        year_suffix = datetime.now().strftime('%Y') if series.year_suffix else ''
-        doc_number = f"{series.prefix}{series.current_number:04d}{'-' + year_suffix if year_suffix else ''}"
+        year_suffix = datetime.now().strftime('%Y') if use_year_suffix else ''
+        doc_number = f"{prefix}{next_number - 1:04d}{'-' + year_suffix if year_suffix else ''}"
         
-        # Increment counter
-        series.current_number += 1
-        series.updated_at = datetime.utcnow()
         db.session.commit()
         
         return doc_number
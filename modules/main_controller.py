@@ -2,6 +2,7 @@
 Main Controller to integrate all modules
 Provides a unified interface to register all module blueprints
 """
+import logging
 from flask import Flask
 from modules.grpo.routes import grpo_bp
 from modules.inventory_transfer.routes import transfer_bp
@@ -37,14 +38,13 @@ def register_modules(app: Flask):
             'modules/so_against_invoice/templates'
         ])
     
-    print("All modules registered successfully")
-    print("Module structure:")
-    print("   - GRPO Module: /grpo/*")
-    print("   - Inventory Transfer Module: /inventory_transfer/*")
-    print("   - Invoice Creation Module: /invoice_creation/*")
-    print("   - Serial Item Transfer Module: /serial-item-transfer/*")
-    print("   - SO Against Invoice Module: /so-against-invoice/*")
-    print("   - Shared Models: modules/shared/models.py")
+    # Module structure only at debug level to keep worker boot output short
+    logging.info("All modules registered successfully")
+    logging.debug(
+        "Module structure: GRPO /grpo/*, Inventory Transfer /inventory_transfer/*, "
+        "Invoice Creation /invoice_creation/*, Serial Item Transfer /serial-item-transfer/*, "
+        "SO Against Invoice /so-against-invoice/*, Shared Models modules/shared/models.py"
+    )
 
 def get_module_info():
     """Get information about available modules"""
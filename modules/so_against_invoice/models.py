@@ -5,10 +5,20 @@ from datetime import datetime
 from app import db
 from flask_login import UserMixin
 
+# Searchable text of a document, as DDL for the PostgreSQL trigram index.
+# so_search_clause() builds the same expression for queries.
+SO_SEARCH_EXPRESSION = (
+    "coalesce(document_number, '') || ' ' || coalesce(so_number, '') || ' ' || "
+    "coalesce(card_code, '') || ' ' || coalesce(card_name, '') || ' ' || coalesce(status, '')"
+)
+
 
 class SOInvoiceDocument(db.Model):
     """SO Against Invoice Document Header"""
     __tablename__ = 'so_invoice_documents'
+    __table_args__ = (
+        db.Index('ix_soinv_created_id', 'created_at', 'id'),  # Keyset pagination on the index page
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     document_number = db.Column(db.String(50), nullable=False, unique=True)
@@ -45,6 +55,22 @@ class SOInvoiceDocument(db.Model):
     items = db.relationship('SOInvoiceItem', backref='so_invoice', lazy=True, cascade='all, delete-orphan')
 
 
+def so_search_clause():
+    """SO_SEARCH_EXPRESSION built from qualified SOInvoiceDocument columns.
+
+    Qualified names keep it unambiguous when the query joins other tables, and the
+    empty/space strings render inline so PostgreSQL matches the ix_soinv_search index.
+    """
+    empty = db.literal_column("''", db.String)
+    space = db.literal_column("' '", db.String)
+    columns = (SOInvoiceDocument.document_number, SOInvoiceDocument.so_number,
+               SOInvoiceDocument.card_code, SOInvoiceDocument.card_name, SOInvoiceDocument.status)
+    clause = db.func.coalesce(columns[0], empty)
+    for column in columns[1:]:
+        clause = clause + space + db.func.coalesce(column, empty)
+    return clause
+
+
 class SOInvoiceItem(db.Model):
     """SO Against Invoice Line Items"""
     __tablename__ = 'so_invoice_items'
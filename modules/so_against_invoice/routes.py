@@ -2,21 +2,84 @@
 Routes for SO Against Invoice Module
 Implements the complete workflow for creating invoices against Sales Orders
 """
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, abort
 from flask_login import login_required, current_user
+from sqlalchemy import and_, or_, update
+from sqlalchemy.orm import selectinload
 # from flask_wtf.csrf import validate_csrf  # Disabled per user request
 from datetime import datetime, timedelta
+import base64
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import json
 import os
+import threading
+import time
 
 from app import app, db
 from models import User, DocumentNumberSeries
-from .models import SOInvoiceDocument, SOInvoiceItem, SOInvoiceSerial, SOSeries
-from sap_integration import SAPIntegration
+from .models import SOInvoiceDocument, SOInvoiceItem, SOInvoiceSerial, SOSeries, so_search_clause
+from sap_integration import get_sap
+import cache
 
 # Create blueprint for SO Against Invoice module
 so_invoice_bp = Blueprint('so_against_invoice', __name__, template_folder='templates', url_prefix='/so-against-invoice')
+logger = logging.getLogger(__name__)
+
+# SAP lookup cache keys and TTLs (seconds)
+SO_SERIES_CACHE_KEY = 'so_series:list'
+SO_SERIES_CACHE_TTL = 600
+SO_VALIDATE_CACHE_TTL = 300
+SO_ORDER_CACHE_TTL = 60
+
+# Concurrent SAP requests per batch validation call, and the most items one call may validate
+SAP_BATCH_MAX_WORKERS = 10
+SAP_BATCH_MAX_ITEMS = 100
+
+# Invoice posts run here so the request thread returns immediately
+_posting_executor = ThreadPoolExecutor(max_workers=4)
+SAP_INVOICE_POST_TIMEOUT = 30
+# A 'posting' claim older than this belongs to a job whose worker died; it may be claimed again
+POSTING_CLAIM_STALE_AFTER = SAP_INVOICE_POST_TIMEOUT + 300
+
+# Background cache warmer, off by default. It polls SAP every interval even with no
+# traffic and holds a Service Layer session (licence seat) per worker, so enable it
+# only where that cost is wanted. When on, it starts with the first request a process
+# serves (CLI commands and the reloader parent never poll SAP); the cache is per
+# process, so each serving worker runs its own warmer.
+#   SO_CACHE_WARMER=1          enable it
+#   SO_CACHE_WARM_INTERVAL=50  seconds between refreshes; keep below SO_ORDER_CACHE_TTL
+#                              so warmed orders never lapse
+SO_CACHE_WARMER_ENABLED = os.environ.get('SO_CACHE_WARMER', '0') == '1'
+SO_CACHE_WARM_INTERVAL = int(os.environ.get('SO_CACHE_WARM_INTERVAL', 50))
+SO_CACHE_WARM_ORDERS = 50
+_cache_warmer_started = False
+_cache_warmer_lock = threading.Lock()
+
+
+def so_validate_cache_key(series, so_number):
+    return f'so:validate:{series}:{so_number}'
+
+
+def so_order_cache_key(doc_entry):
+    return f'so:order:{doc_entry}'
+
+
+def encode_page_cursor(document):
+    """Opaque keyset cursor pointing just after document in (created_at, id) DESC order"""
+    raw = f"{document.created_at.isoformat()}|{document.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_page_cursor(token):
+    """Return (created_at, id) from a cursor token, or None if it is malformed"""
+    try:
+        created_at, doc_id = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(doc_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
 
 
 def generate_so_invoice_number():
@@ -29,6 +92,31 @@ def is_production_environment():
     return not (app.debug or os.environ.get('FLASK_ENV') == 'development')
 
 
+def can_access_document(doc_id):
+    """Ownership check that reads only user_id; admins and managers skip the query.
+
+    Aborts with 404 when the document does not exist.
+    """
+    if current_user.role in ['admin', 'manager']:
+        return True
+    owner_id = db.session.query(SOInvoiceDocument.user_id).filter_by(id=doc_id).scalar()
+    if owner_id is None:
+        abort(404)
+    return owner_id == current_user.id
+
+
+def conditional_json(payload, max_age=60):
+    """jsonify with a content ETag for GET responses; answers 304 with no body when If-None-Match matches.
+
+    make_conditional uses the weak comparison If-None-Match requires, so W/ ETags
+    rewritten by a gzip proxy still match.
+    """
+    response = jsonify(payload)
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    return response.make_conditional(request)
+
+
 def validate_json_csrf():
     """CSRF validation disabled per user request"""
     # CSRF protection has been disabled globally - always return True
@@ -45,7 +133,7 @@ def index():
     
     try:
         # Get pagination parameters
-        page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor', '', type=str)
         per_page = request.args.get('per_page', 10, type=int)
         search = request.args.get('search', '', type=str)
         
@@ -63,35 +151,70 @@ def index():
         # Apply search filter if provided
         if search:
             search_filter = f"%{search}%"
+            if app.config.get('DB_TYPE') == 'postgresql':
+                # One ILIKE over the ix_soinv_search trigram index instead of five leading-wildcard scans
+                query = query.filter(so_search_clause().ilike(search_filter))
+            else:
+                query = query.filter(
+                    db.or_(
+                        SOInvoiceDocument.document_number.ilike(search_filter),
+                        SOInvoiceDocument.so_number.ilike(search_filter),
+                        SOInvoiceDocument.card_code.ilike(search_filter),
+                        SOInvoiceDocument.card_name.ilike(search_filter),
+                        SOInvoiceDocument.status.ilike(search_filter)
+                    )
+                )
+        
+        # Keyset pagination: seek past the last row of the previous page instead of OFFSET
+        cursor_key = decode_page_cursor(cursor) if cursor else None
+        if cursor_key:
+            cursor_created_at, cursor_id = cursor_key
             query = query.filter(
                 db.or_(
-                    SOInvoiceDocument.document_number.ilike(search_filter),
-                    SOInvoiceDocument.so_number.ilike(search_filter),
-                    SOInvoiceDocument.card_code.ilike(search_filter),
-                    SOInvoiceDocument.card_name.ilike(search_filter),
-                    SOInvoiceDocument.status.ilike(search_filter)
+                    SOInvoiceDocument.created_at < cursor_created_at,
+                    db.and_(SOInvoiceDocument.created_at == cursor_created_at,
+                            SOInvoiceDocument.id < cursor_id)
                 )
             )
         
-        # Order and paginate
-        query = query.order_by(SOInvoiceDocument.created_at.desc())
-        documents_paginated = query.paginate(
-            page=page, per_page=per_page, error_out=False
+        # Only the columns the list renders, with the creator's username joined in
+        # (lightweight Rows instead of ORM objects plus a lazy user load per row)
+        query = query.join(User, SOInvoiceDocument.user_id == User.id).with_entities(
+            SOInvoiceDocument.id,
+            SOInvoiceDocument.document_number,
+            SOInvoiceDocument.so_number,
+            SOInvoiceDocument.card_code,
+            SOInvoiceDocument.card_name,
+            SOInvoiceDocument.sap_invoice_number,
+            SOInvoiceDocument.status,
+            SOInvoiceDocument.created_at,
+            User.username
         )
         
+        query = query.order_by(SOInvoiceDocument.created_at.desc(), SOInvoiceDocument.id.desc())
+        documents = query.limit(per_page + 1).all()
+        
+        # The extra row only tells us whether another page exists
+        next_cursor = None
+        if len(documents) > per_page:
+            documents = documents[:per_page]
+            next_cursor = encode_page_cursor(documents[-1])
+        
         return render_template('index.html',
-                             documents=documents_paginated.items,
-                             pagination=documents_paginated,
+                             documents=documents,
+                             cursor=cursor if cursor_key else '',
+                             next_cursor=next_cursor,
                              search=search,
                              per_page=per_page,
                              current_user=current_user)
     
     except Exception as e:
-        logging.error(f"Error in SO Against Invoice index: {str(e)}")
+        logger.error("Error in SO Against Invoice index: %s", e)
         flash(f'Error loading documents: {str(e)}', 'error')
         return render_template('index.html',
                              documents=[],
-                             pagination=None,
+                             cursor='',
+                             next_cursor=None,
                              search='',
                              per_page=10,
                              current_user=current_user)
@@ -127,7 +250,7 @@ def create():
     
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Error creating SO Against Invoice: {str(e)}")
+        logger.error("Error creating SO Against Invoice: %s", e)
         flash(f'Error creating document: {str(e)}', 'error')
         return render_template('create.html')
 
@@ -141,23 +264,106 @@ def detail(doc_id):
         return redirect(url_for('dashboard'))
     
     try:
-        document = SOInvoiceDocument.query.get_or_404(doc_id)
-        
-        # Check permissions
-        if current_user.role not in ['admin', 'manager'] and document.user_id != current_user.id:
+        # Check permissions before loading the document and its items
+        if not can_access_document(doc_id):
             flash('Access denied - You can only view your own documents', 'error')
             return redirect(url_for('so_against_invoice.index'))
         
+        # The page renders every line item; load them with the document
+        document = SOInvoiceDocument.query.options(
+            selectinload(SOInvoiceDocument.items)
+        ).filter_by(id=doc_id).first_or_404()
+        
         return render_template('detail.html', 
                              document=document,
                              current_user=current_user)
     
     except Exception as e:
-        logging.error(f"Error loading SO Against Invoice detail: {str(e)}")
+        logger.error("Error loading SO Against Invoice detail: %s", e)
         flash(f'Error loading document: {str(e)}', 'error')
         return redirect(url_for('so_against_invoice.index'))
 
 
+def refresh_so_series(sap):
+    """Fetch SO series from SAP B1, store new ones in the database and refresh the cache.
+
+    Returns the series list, or None if SAP did not answer with 200.
+    """
+    url = f"{sap.base_url}/b1s/v1/SQLQueries('Get_SO_Series')/List"
+    response = sap.session.post(url, json={}, timeout=10)
+    
+    if response.status_code != 200:
+        return None
+    
+    series_list = response.json().get('value', [])
+    
+    # Cache series in database for faster lookup (offline fallback).
+    # One IN query tells us which of the incoming series are already stored.
+    incoming = [series_data['Series'] for series_data in series_list]
+    existing_series = set()
+    if incoming:
+        existing_series = {
+            row[0] for row in db.session.query(SOSeries.series).filter(SOSeries.series.in_(incoming))
+        }
+    new_series = [
+        SOSeries(series=series_data['Series'], series_name=series_data['SeriesName'])
+        for series_data in series_list
+        if series_data['Series'] not in existing_series
+    ]
+    if new_series:
+        db.session.bulk_save_objects(new_series)
+        db.session.commit()
+    cache.put(SO_SERIES_CACHE_KEY, series_list, SO_SERIES_CACHE_TTL)
+    logger.info("Retrieved %s SO series from SAP B1", len(series_list))
+    return series_list
+
+
+def warm_so_cache():
+    """Pre-load SO series and the most recent open Sales Orders into the cache"""
+    sap = get_sap()
+    if not sap.ensure_logged_in():
+        return
+    
+    refresh_so_series(sap)
+    
+    # One Orders query for the latest open SOs instead of one call per DocEntry
+    url = (f"{sap.base_url}/b1s/v1/Orders?$filter=DocumentStatus eq 'bost_Open'"
+           f"&$orderby=DocEntry desc&$top={SO_CACHE_WARM_ORDERS}")
+    response = sap.session.get(url, headers={'Prefer': f'odata.maxpagesize={SO_CACHE_WARM_ORDERS}'}, timeout=30)
+    
+    if response.status_code == 200:
+        orders = response.json().get('value', [])
+        for order in orders:
+            cache.put(so_order_cache_key(order.get('DocEntry')), order, SO_ORDER_CACHE_TTL)
+        logger.debug("Warmed cache with %s open Sales Orders", len(orders))
+
+
+def _cache_warmer_loop(flask_app):
+    while True:
+        with flask_app.app_context():
+            try:
+                warm_so_cache()
+            except Exception as e:
+                logger.warning("⚠️ SO cache warm-up failed: %s", e)
+            finally:
+                db.session.remove()
+        time.sleep(SO_CACHE_WARM_INTERVAL)
+
+
+@so_invoice_bp.before_app_request
+def _start_cache_warmer():
+    """Start the background warmer once per serving process when SAP B1 is configured"""
+    global _cache_warmer_started
+    if _cache_warmer_started:
+        return
+    with _cache_warmer_lock:
+        if _cache_warmer_started:
+            return
+        _cache_warmer_started = True
+    if not SO_CACHE_WARMER_ENABLED or not get_sap().base_url:
+        return
+    threading.Thread(target=_cache_warmer_loop, args=(app,), daemon=True).start()
+
 # Step 1: Get Sales Order Series API
 @so_invoice_bp.route('/api/get-so-series', methods=['GET'])
 @login_required
@@ -170,44 +376,35 @@ def get_so_series():
         }), 403
     
     try:
-        sap = SAPIntegration()
+        # Serve from cache when warm - skips both the SAP call and the database
+        series_list = cache.get(SO_SERIES_CACHE_KEY)
+        if series_list is not None:
+            return conditional_json({
+                'success': True,
+                'series': series_list
+            })
+
+        sap = get_sap()
         
         # Try to get series from SAP B1
         if sap.ensure_logged_in():
             try:
-                url = f"{sap.base_url}/b1s/v1/SQLQueries('Get_SO_Series')/List"
-                response = sap.session.post(url, json={}, timeout=10)
+                series_list = refresh_so_series(sap)
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    series_list = data.get('value', [])
-                    
-                    # Cache series in database for faster lookup
-                    for series_data in series_list:
-                        existing_series = SOSeries.query.filter_by(series=series_data['Series']).first()
-                        if not existing_series:
-                            new_series = SOSeries(
-                                series=series_data['Series'],
-                                series_name=series_data['SeriesName']
-                            )
-                            db.session.add(new_series)
-                    
-                    db.session.commit()
-                    logging.info(f"Retrieved {len(series_list)} SO series from SAP B1")
-                    
-                    return jsonify({
+                if series_list is not None:
+                    return conditional_json({
                         'success': True,
                         'series': series_list
                     })
                     
             except Exception as e:
-                logging.error(f"Error getting SO series from SAP: {str(e)}")
+                logger.error("Error getting SO series from SAP: %s", e)
         
         # Fallback to cached data or mock data
         cached_series = SOSeries.query.all()
         if cached_series:
             series_list = [{'Series': s.series, 'SeriesName': s.series_name} for s in cached_series]
-            return jsonify({
+            return conditional_json({
                 'success': True,
                 'series': series_list
             })
@@ -229,7 +426,7 @@ def get_so_series():
         })
     
     except Exception as e:
-        logging.error(f"Error in get_so_series API: {str(e)}")
+        logger.error("Error in get_so_series API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -264,7 +461,16 @@ def validate_so_number():
                 'error': 'SO Number and Series are required'
             }), 400
         
-        sap = SAPIntegration()
+        validate_cache_key = so_validate_cache_key(series, so_number)
+        doc_entry = cache.get(validate_cache_key)
+        if doc_entry is not None:
+            return jsonify({
+                'success': True,
+                'doc_entry': doc_entry,
+                'message': f'SO {so_number} validated successfully'
+            })
+
+        sap = get_sap()
         
         # Try to validate with SAP B1
         if sap.ensure_logged_in():
@@ -281,6 +487,7 @@ def validate_so_number():
                     
                     if so_details:
                         doc_entry = so_details[0].get('DocEntry')
+                        cache.put(validate_cache_key, doc_entry, SO_VALIDATE_CACHE_TTL)
                         return jsonify({
                             'success': True,
                             'doc_entry': doc_entry,
@@ -293,7 +500,7 @@ def validate_so_number():
                         }), 404
                         
             except Exception as e:
-                logging.error(f"Error validating SO with SAP: {str(e)}")
+                logger.error("Error validating SO with SAP: %s", e)
         
         # Strict production check - never allow mock validation in production
         if is_production_environment():
@@ -303,7 +510,7 @@ def validate_so_number():
             }), 503
         
         # Development mode only - with clear warnings
-        logging.warning(f"DEVELOPMENT MODE: Mock validation for SO {so_number}")
+        logger.warning("DEVELOPMENT MODE: Mock validation for SO %s", so_number)
         return jsonify({
             'success': True,
             'doc_entry': 1248,
@@ -313,7 +520,7 @@ def validate_so_number():
         })
     
     except Exception as e:
-        logging.error(f"Error in validate_so_number API: {str(e)}")
+        logger.error("Error in validate_so_number API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -347,7 +554,7 @@ def validate_so_number():
 #                 'error': 'DocEntry is required'
 #             }), 400
 #
-#         sap = SAPIntegration()
+#         sap = get_sap()
 #
 #         # Try to fetch from SAP B1
 #         if sap.ensure_logged_in():
@@ -429,46 +636,52 @@ def fetch_so_details():
                 'error': 'DocEntry is required'
             }), 400
 
-        sap = SAPIntegration()
+        order_cache_key = so_order_cache_key(doc_entry)
+        order = cache.get(order_cache_key)
 
-        if sap.ensure_logged_in():
-            try:
-                url = f"{sap.base_url}/b1s/v1/Orders?$filter=DocEntry eq {doc_entry}"
-                response = sap.session.get(url, timeout=10)
+        if order is None:
+            sap = get_sap()
 
-                if response.status_code == 200:
-                    data = response.json()
-                    orders = data.get('value', [])
+            if sap.ensure_logged_in():
+                try:
+                    url = f"{sap.base_url}/b1s/v1/Orders?$filter=DocEntry eq {doc_entry}"
+                    response = sap.session.get(url, timeout=10)
 
-                    if orders:
-                        order = orders[0]
+                    if response.status_code == 200:
+                        data = response.json()
+                        orders = data.get('value', [])
 
-                        # ✅ Check DocumentStatus
-                        if order.get("DocumentStatus") != "bost_Open":
+                        if not orders:
                             return jsonify({
                                 'success': False,
-                                'error': f"SO {doc_entry} is already closed"
-                            }), 400
+                                'error': f'SO with DocEntry {doc_entry} not found'
+                            }), 404
 
-                        # ✅ Filter only open lines
-                        open_lines = [
-                            line for line in order.get("DocumentLines", [])
-                            if line.get("LineStatus") == "bost_Open"
-                        ]
-                        order["DocumentLines"] = open_lines
+                        order = orders[0]
+                        cache.put(order_cache_key, order, SO_ORDER_CACHE_TTL)
 
-                        return jsonify({
-                            'success': True,
-                            'order': order
-                        })
-                    else:
-                        return jsonify({
-                            'success': False,
-                            'error': f'SO with DocEntry {doc_entry} not found'
-                        }), 404
+                except Exception as e:
+                    logger.error("Error fetching SO details from SAP: %s", e)
 
-            except Exception as e:
-                logging.error(f"Error fetching SO details from SAP: {str(e)}")
+        if order is not None:
+            # ✅ Check DocumentStatus
+            if order.get("DocumentStatus") != "bost_Open":
+                return jsonify({
+                    'success': False,
+                    'error': f"SO {doc_entry} is already closed"
+                }), 400
+
+            # ✅ Filter only open lines (on a copy - the cached order is shared)
+            order = dict(order)
+            order["DocumentLines"] = [
+                line for line in order.get("DocumentLines", [])
+                if line.get("LineStatus") == "bost_Open"
+            ]
+
+            return jsonify({
+                'success': True,
+                'order': order
+            })
 
         if is_production_environment():
             return jsonify({
@@ -478,7 +691,7 @@ def fetch_so_details():
 
         # Dev mode mock
         mock_order = {}
-        logging.warning(f"DEVELOPMENT MODE: Mock SO data for DocEntry {doc_entry}")
+        logger.warning("DEVELOPMENT MODE: Mock SO data for DocEntry %s", doc_entry)
         return jsonify({
             'success': True,
             'order': mock_order,
@@ -487,7 +700,7 @@ def fetch_so_details():
         })
 
     except Exception as e:
-        logging.error(f"Error in fetch_so_details API: {str(e)}")
+        logger.error("Error in fetch_so_details API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -525,7 +738,7 @@ def validate_item():
                 'error': 'ItemCode and WarehouseCode are required'
             }), 400
         
-        sap = SAPIntegration()
+        sap = get_sap()
         
         if item_type == 'serial' and serial_number:
             # Scenario 1: Serial Number Managed Items
@@ -557,7 +770,7 @@ def validate_item():
                             })
                             
                 except Exception as e:
-                    logging.error(f"Error validating serial with SAP: {str(e)}")
+                    logger.error("Error validating serial with SAP: %s", e)
             
             # Strict production check for serial validation
             if is_production_environment():
@@ -567,7 +780,7 @@ def validate_item():
                 }), 503
             
             # Development mode only - with clear warnings
-            logging.warning(f"DEVELOPMENT MODE: Mock serial validation for {serial_number}")
+            logger.warning("DEVELOPMENT MODE: Mock serial validation for %s", serial_number)
             return jsonify({
                 'success': True,
                 'validated': True,
@@ -620,7 +833,7 @@ def validate_item():
                             }), 404
                             
                 except Exception as e:
-                    logging.error(f"Error checking stock with SAP: {str(e)}")
+                    logger.error("Error checking stock with SAP: %s", e)
             
             # Production environment - require SAP connection
             if is_production_environment():
@@ -630,7 +843,7 @@ def validate_item():
                 }), 503
             
             # Development mode fallback
-            logging.warning(f"DEVELOPMENT MODE: Mock quantity validation for {item_code}")
+            logger.warning("DEVELOPMENT MODE: Mock quantity validation for %s", item_code)
             return jsonify({
                 'success': True,
                 'validated': True,
@@ -649,18 +862,199 @@ def validate_item():
             }), 400
     
     except Exception as e:
-        logging.error(f"Error in validate_item API: {str(e)}")
+        logger.error("Error in validate_item API: %s", e)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+
+def _validate_serial_with_sap(sap, item):
+    """Validate one {item_code, warehouse_code, serial_number} entry via Series_Validation"""
+    item_code = item.get('item_code')
+    warehouse_code = item.get('warehouse_code')
+    serial_number = item.get('serial_number')
+
+    if not item_code or not warehouse_code or not serial_number:
+        return {
+            'success': False,
+            'serial_number': serial_number,
+            'error': 'ItemCode, WarehouseCode and SerialNumber are required'
+        }
+
+    try:
+        url = f"{sap.base_url}/b1s/v1/SQLQueries('Series_Validation')/List"
+        request_body = {
+            "ParamList": f"whsCode='{warehouse_code}'&itemCode='{item_code}'&series='{serial_number}'"
+        }
+        response = sap.session.post(url, json=request_body, timeout=10)
+
+        if response.status_code == 200:
+            serial_details = response.json().get('value', [])
+            if serial_details:
+                return {
+                    'success': True,
+                    'validated': True,
+                    'serial_number': serial_number,
+                    'serial_info': serial_details[0]
+                }
+            return {
+                'success': False,
+                'serial_number': serial_number,
+                'error': f'Serial {serial_number} not found for item {item_code} in warehouse {warehouse_code}'
+            }
+
+        return {
+            'success': False,
+            'serial_number': serial_number,
+            'error': f'SAP B1 returned status {response.status_code}'
+        }
+
+    except Exception as e:
+        logger.error("Error validating serial %s with SAP: %s", serial_number, e)
+        return {
+            'success': False,
+            'serial_number': serial_number,
+            'error': str(e)
+        }
+
+
+@so_invoice_bp.route('/api/validate-items-batch', methods=['POST'])
+@login_required
+def validate_items_batch():
+    """Validate a list of serial numbers concurrently against SAP B1"""
+    if not current_user.has_permission('so_against_invoice'):
+        return jsonify({
+            'success': False,
+            'error': 'Access denied - SO Against Invoice permissions required'
+        }), 403
+
+    try:
+        # Validate CSRF token for JSON requests
+        if not validate_json_csrf():
+            return jsonify({
+                'success': False,
+                'error': 'CSRF validation failed'
+            }), 403
+        data = request.get_json() or {}
+        items = data.get('items', [])
+
+        if not items:
+            return jsonify({
+                'success': False,
+                'error': 'items list is required'
+            }), 400
+
+        if len(items) > SAP_BATCH_MAX_ITEMS:
+            return jsonify({
+                'success': False,
+                'error': f'At most {SAP_BATCH_MAX_ITEMS} items can be validated per request'
+            }), 400
+
+        sap = get_sap()
+
+        if sap.ensure_logged_in():
+            # One login, then the Series_Validation calls share the session and overlap
+            with ThreadPoolExecutor(max_workers=min(SAP_BATCH_MAX_WORKERS, len(items))) as executor:
+                results = list(executor.map(lambda item: _validate_serial_with_sap(sap, item), items))
+
+            return jsonify({
+                'success': all(result['success'] for result in results),
+                'results': results
+            })
+
+        # Strict production check for serial validation
+        if is_production_environment():
+            return jsonify({
+                'success': False,
+                'error': 'SAP B1 service unavailable - cannot validate serial numbers in production without live connection'
+            }), 503
+
+        # Development mode only - with clear warnings
+        logger.warning("DEVELOPMENT MODE: Mock batch serial validation for %s items", len(items))
+        return jsonify({
+            'success': True,
+            'results': [{
+                'success': True,
+                'validated': True,
+                'serial_number': item.get('serial_number'),
+                'serial_info': {
+                    'DistNumber': item.get('serial_number'),
+                    'ItemCode': item.get('item_code'),
+                    'WhsCode': item.get('warehouse_code')
+                }
+            } for item in items],
+            'development_mode': True,
+            'warning': 'Development mode - serials not validated against real data'
+        })
+
+    except Exception as e:
+        logger.error("Error in validate_items_batch API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 
+def build_invoice_payload(document):
+    """SAP B1 Invoice body for a document, or None if it has no line items.
+
+    Items and serials come from two flat column queries grouped in Python, so no
+    ORM objects or relationship loads are involved.
+    """
+    items = db.session.query(
+        SOInvoiceItem.id, SOInvoiceItem.item_code, SOInvoiceItem.item_description,
+        SOInvoiceItem.validated_quantity, SOInvoiceItem.warehouse_code
+    ).filter_by(so_invoice_id=document.id).order_by(SOInvoiceItem.id).all()
+    
+    if not items:
+        return None
+    
+    serials_by_item = defaultdict(list)
+    serial_rows = db.session.query(
+        SOInvoiceSerial.so_invoice_item_id, SOInvoiceSerial.serial_number,
+        SOInvoiceSerial.quantity, SOInvoiceSerial.base_line_number
+    ).filter(SOInvoiceSerial.so_invoice_item_id.in_([item.id for item in items])).order_by(SOInvoiceSerial.id)
+    for item_id, serial_number, quantity, base_line_number in serial_rows:
+        serials_by_item[item_id].append({
+            "InternalSerialNumber": serial_number,
+            "Quantity": quantity,
+            "BaseLineNumber": base_line_number
+        })
+    
+    document_lines = []
+    for item in items:
+        line_data = {
+            "ItemCode": item.item_code,
+            "ItemDescription": item.item_description,
+            "Quantity": item.validated_quantity,
+            "WarehouseCode": item.warehouse_code
+        }
+        # Add serial numbers if any
+        if item.id in serials_by_item:
+            line_data["SerialNumbers"] = serials_by_item[item.id]
+        document_lines.append(line_data)
+    
+    #bplId = sap.get_warehouse_business_place_id(item.warehouse_code)
+    return {
+        "DocDate": document.doc_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "DocDueDate": (document.doc_due_date or document.doc_date + timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "BPL_IDAssignedToInvoice": document.bplid,
+        "CardCode": document.card_code,
+        "Comments": f"SO Against Invoice - {document.document_number}",
+        "DocumentLines": document_lines
+    }
+
 # Step 5: Post Invoice to SAP B1
 @so_invoice_bp.route('/api/post-invoice', methods=['POST'])
 @login_required
 def post_invoice():
-    """Post validated invoice to SAP B1"""
+    """Validate the document, build the SAP payload and queue the post to SAP B1.
+
+    A repeated request (double-click, network retry) gets a 409 from the atomic
+    'posting' claim below, whichever worker it lands on.
+    """
     if not current_user.has_permission('so_against_invoice'):
         return jsonify({
             'success': False,
@@ -683,137 +1077,146 @@ def post_invoice():
                 'error': 'Document ID is required'
             }), 400
         
-        document = SOInvoiceDocument.query.get_or_404(doc_id)
-
-        # Check permissions
-        if current_user.role not in ['admin', 'manager'] and document.user_id != current_user.id:
+        # Check permissions before loading the document
+        if not can_access_document(doc_id):
             return jsonify({
                 'success': False,
                 'error': 'Access denied'
             }), 403
         
+        document = SOInvoiceDocument.query.get_or_404(doc_id)
+        
+        # Build invoice request for SAP B1 from the current lines. Not cached: the cache is
+        # per process, so an edit handled by another worker could not invalidate it.
+        invoice_data = build_invoice_payload(document)
+        
         # Validate document has items
-        if not document.items:
+        if invoice_data is None:
             return jsonify({
                 'success': False,
                 'error': 'Cannot post invoice without line items'
             }), 400
-        sap = SAPIntegration()
-        # Build invoice request for SAP B1
-        #bplId = sap.get_warehouse_business_place_id(item.warehouse_code)
-        invoice_data = {
-            "DocDate": document.doc_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "DocDueDate": (document.doc_due_date or document.doc_date + timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "BPL_IDAssignedToInvoice": document.bplid,
-            "CardCode": document.card_code,
-            "U_EA_CREATEDBy": current_user.username,
-            "U_EA_Approved": current_user.username,
-            "Comments": f"SO Against Invoice - {document.document_number}",
-            "DocumentLines": []
-        }
         
-        # Add line items
-        for item in document.items:
+        invoice_data["U_EA_CREATEDBy"] = current_user.username
+        invoice_data["U_EA_Approved"] = current_user.username
+        logger.debug("Invoice payload for document %s: %s", document.id, invoice_data)
+        
+        # Claim the document in a single UPDATE so only one request (across threads and
+        # workers) can move it to 'posting'; a stale claim from a dead worker is retryable
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(SOInvoiceDocument)
+            .where(
+                SOInvoiceDocument.id == document.id,
+                or_(
+                    SOInvoiceDocument.status.is_(None),
+                    SOInvoiceDocument.status.notin_(['posting', 'posted']),
+                    and_(SOInvoiceDocument.status == 'posting',
+                         SOInvoiceDocument.updated_at < now - timedelta(seconds=POSTING_CLAIM_STALE_AFTER))
+                )
+            )
+            .values(status='posting', posting_error=None, updated_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        
+        if not claimed:
+            return jsonify({
+                'success': False,
+                'error': 'Invoice is already being posted to or has been posted to SAP B1'
+            }), 409
+        
+        # Hand the SAP post to a background worker; the client polls the status endpoint
+        _posting_executor.submit(_post_invoice_job, document.id, invoice_data)
+        
+        return jsonify({
+            'success': True,
+            'doc_id': document.id,
+            'status': 'posting',
+            'status_url': url_for('so_against_invoice.post_invoice_status', doc_id=document.id),
+            'message': 'Invoice queued for posting to SAP B1'
+        }), 202
+    
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Error in post_invoice API: %s", e)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
 
-            line_data = {
-                "ItemCode": item.item_code,
-                "ItemDescription": item.item_description,
-                "Quantity": item.validated_quantity,
-                "WarehouseCode": item.warehouse_code
-            }
-            
-            # Add serial numbers if any
-            if item.serial_numbers:
-                line_data["SerialNumbers"] = []
-                for serial in item.serial_numbers:
-                    line_data["SerialNumbers"].append({
-                        "InternalSerialNumber": serial.serial_number,
-                        "Quantity": serial.quantity,
-                        "BaseLineNumber": serial.base_line_number
-                    })
-            
-            invoice_data["DocumentLines"].append(line_data)
-        print(invoice_data)
-        # Try to post to SAP B1
-        if sap.ensure_logged_in():
-            try:
+
+def _post_invoice_job(doc_id, invoice_data):
+    """Post invoice_data to SAP B1 and record the outcome on the document"""
+    with app.app_context():
+        document = db.session.get(SOInvoiceDocument, doc_id)
+        try:
+            sap = get_sap()
+            if sap.ensure_logged_in():
                 url = f"{sap.base_url}/b1s/v1/Invoices"
-                response = sap.session.post(url, json=invoice_data, timeout=30)
+                response = sap.session.post(url, json=invoice_data, timeout=SAP_INVOICE_POST_TIMEOUT)
                 
                 if response.status_code in [200, 201]:
-                    result_data = response.json()
-                    sap_doc_num = result_data.get('DocNum')
-                    
-                    # Update document with SAP details
+                    sap_doc_num = response.json().get('DocNum')
                     document.sap_invoice_number = str(sap_doc_num)
                     document.status = 'posted'
-                    document.updated_at = datetime.utcnow()
-                    
-                    db.session.commit()
-                    
-                    return jsonify({
-                        'success': True,
-                        'sap_doc_num': sap_doc_num,
-                        'message': f'Invoice posted successfully to SAP B1. DocNum: {sap_doc_num}'
-                    })
+                    logger.info("Invoice posted to SAP B1 for document %s. DocNum: %s", doc_id, sap_doc_num)
                 else:
-                    error_msg = f"SAP B1 error: {response.status_code} - {response.text}"
-                    document.posting_error = error_msg
+                    document.posting_error = f"SAP B1 error: {response.status_code} - {response.text}"
                     document.status = 'failed'
-                    db.session.commit()
-                    
-                    return jsonify({
-                        'success': False,
-                        'error': error_msg
-                    }), 400
-                    
-            except Exception as e:
-                error_msg = f"Error posting to SAP B1: {str(e)}"
-                document.posting_error = error_msg
+            
+            # CRITICAL: Never allow fake posting in production
+            elif is_production_environment():
+                document.posting_error = "SAP B1 service unavailable - invoice posting failed"
                 document.status = 'failed'
-                db.session.commit()
-                
-                logging.error(error_msg)
-                return jsonify({
-                    'success': False,
-                    'error': error_msg
-                }), 500
+            
+            # Development mode only - with clear simulation markers
+            else:
+                document.sap_invoice_number = f"DEV-INV{document.id:06d}"
+                document.status = 'posted'
+                logger.warning("DEVELOPMENT MODE: Simulated invoice posting for document %s", document.id)
         
-        # CRITICAL: Never allow fake posting in production
-        if is_production_environment():
-            document.posting_error = "SAP B1 service unavailable - invoice posting failed"
+        except Exception as e:
+            document.posting_error = f"Error posting to SAP B1: {str(e)}"
             document.status = 'failed'
-            db.session.commit()
-            
-            return jsonify({
-                'success': False,
-                'error': 'SAP B1 service unavailable - cannot post invoices in production without live connection',
-                'critical_error': True
-            }), 503
+            logger.error(document.posting_error)
         
-        # Development mode only - with clear simulation markers
-        document.sap_invoice_number = f"DEV-INV{document.id:06d}"
-        document.status = 'posted'
         document.updated_at = datetime.utcnow()
         db.session.commit()
-        
-        logging.warning(f"DEVELOPMENT MODE: Simulated invoice posting for document {document.id}")
+
+
+@so_invoice_bp.route('/api/post-invoice/status/<int:doc_id>', methods=['GET'])
+@login_required
+def post_invoice_status(doc_id):
+    """Report the SAP posting state of a document queued by post_invoice"""
+    if not current_user.has_permission('so_against_invoice'):
         return jsonify({
-            'success': True,
-            'sap_doc_num': document.sap_invoice_number,
-            'development_mode': True,
-            'warning': 'SIMULATED POSTING - This invoice was NOT posted to real SAP system',
-            'message': f'Invoice simulated successfully (DEVELOPMENT ONLY). DocNum: {document.sap_invoice_number}'
-        })
+            'success': False,
+            'error': 'Access denied - SO Against Invoice permissions required'
+        }), 403
     
-    except Exception as e:
-        db.session.rollback()
-        logging.error(f"Error in post_invoice API: {str(e)}")
+    # Only the columns this poll reports (plus the owner for the permission check)
+    document = db.session.query(
+        SOInvoiceDocument.id, SOInvoiceDocument.user_id, SOInvoiceDocument.status,
+        SOInvoiceDocument.sap_invoice_number, SOInvoiceDocument.posting_error
+    ).filter_by(id=doc_id).first()
+    if document is None:
+        abort(404)
+    
+    # Check permissions
+    if current_user.role not in ['admin', 'manager'] and document.user_id != current_user.id:
         return jsonify({
             'success': False,
-            'error': str(e)
-        }), 500
-
+            'error': 'Access denied'
+        }), 403
+    
+    return jsonify({
+        'success': document.status != 'failed',
+        'doc_id': document.id,
+        'status': document.status,
+        'sap_doc_num': document.sap_invoice_number,
+        'error': document.posting_error
+    })
 
 @so_invoice_bp.route('/api/save-so-details', methods=['POST'])
 @login_required
@@ -858,24 +1261,29 @@ def save_so_details():
         document.status = 'validated'
         
         # Clear existing items and add new ones from SO
-        SOInvoiceItem.query.filter_by(so_invoice_id=doc_id).delete()
+        SOInvoiceItem.query.filter_by(so_invoice_id=doc_id).delete(synchronize_session=False)
         
         order = so_details.get('order', {})
         document_lines = order.get('DocumentLines', [])
         
-        for line in document_lines:
-            item = SOInvoiceItem(
-                so_invoice_id=doc_id,
-                line_num=line.get('LineNum'),
-                item_code=line.get('ItemCode'),
-                item_description=line.get('ItemDescription'),
-                so_quantity=line.get('Quantity'),
-                warehouse_code=line.get('WarehouseCode'),
-                validated_quantity=0  # Will be updated when items are validated
-            )
-            db.session.add(item)
+        # One executemany INSERT for all lines, committed with the document update
+        db.session.bulk_insert_mappings(SOInvoiceItem, [{
+            'so_invoice_id': doc_id,
+            'line_num': line.get('LineNum'),
+            'item_code': line.get('ItemCode'),
+            'item_description': line.get('ItemDescription'),
+            'so_quantity': line.get('Quantity'),
+            'warehouse_code': line.get('WarehouseCode'),
+            'validated_quantity': 0  # Will be updated when items are validated
+        } for line in document_lines])
         
         db.session.commit()
+
+        # Later lookups for this SO should see fresh SAP data
+        cache.delete(
+            so_validate_cache_key(series_info.get('series'), so_details.get('so_number')),
+            so_order_cache_key(so_details.get('doc_entry'))
+        )
         
         return jsonify({
             'success': True,
@@ -884,7 +1292,7 @@ def save_so_details():
     
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Error saving SO details: {str(e)}")
+        logger.error("Error saving SO details: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -920,7 +1328,7 @@ def check_item_stock():
                 'error': 'ItemCode and WarehouseCode are required'
             }), 400
         
-        sap = SAPIntegration()
+        sap = get_sap()
         
         # Try to get stock info from SAP B1
         if sap.ensure_logged_in():
@@ -950,7 +1358,7 @@ def check_item_stock():
                         })
                         
             except Exception as e:
-                logging.error(f"Error checking stock with SAP: {str(e)}")
+                logger.error("Error checking stock with SAP: %s", e)
         
         # Production check for stock information
         if is_production_environment():
@@ -960,7 +1368,7 @@ def check_item_stock():
             }), 503
         
         # Development mode mock data
-        logging.warning(f"DEVELOPMENT MODE: Mock stock check for {item_code}")
+        logger.warning("DEVELOPMENT MODE: Mock stock check for %s", item_code)
         return jsonify({
             'success': True,
             'item_code': item_code,
@@ -971,7 +1379,7 @@ def check_item_stock():
         })
     
     except Exception as e:
-        logging.error(f"Error in check_item_stock API: {str(e)}")
+        logger.error("Error in check_item_stock API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1006,7 +1414,7 @@ def validate_serial():
                 'error': 'ItemCode, WarehouseCode, and SerialNumber are required'
             }), 400
         
-        sap = SAPIntegration()
+        sap = get_sap()
         
         # Try to validate with SAP B1
         if sap.ensure_logged_in():
@@ -1034,7 +1442,7 @@ def validate_serial():
                         })
                         
             except Exception as e:
-                logging.error(f"Error validating serial with SAP: {str(e)}")
+                logger.error("Error validating serial with SAP: %s", e)
         
         # Production check for serial validation
         if is_production_environment():
@@ -1044,7 +1452,7 @@ def validate_serial():
             }), 503
         
         # Development mode mock validation
-        logging.warning(f"DEVELOPMENT MODE: Mock serial validation for {serial_number}")
+        logger.warning("DEVELOPMENT MODE: Mock serial validation for %s", serial_number)
         return jsonify({
             'success': True,
             'serial_number': serial_number,
@@ -1054,7 +1462,7 @@ def validate_serial():
         })
     
     except Exception as e:
-        logging.error(f"Error in validate_serial API: {str(e)}")
+        logger.error("Error in validate_serial API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1153,7 +1561,7 @@ def add_validated_item():
     
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Error in add_validated_item API: {str(e)}")
+        logger.error("Error in add_validated_item API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1213,7 +1621,7 @@ def remove_validated_item():
     
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Error in remove_validated_item API: {str(e)}")
+        logger.error("Error in remove_validated_item API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -1269,7 +1677,7 @@ def post_invoice_to_sap():
             }), 400
 
         # Initialize SAP integration
-        sap = SAPIntegration()
+        sap = get_sap()
         
         if not sap.ensure_logged_in():
             return jsonify({
@@ -1330,8 +1738,8 @@ def post_invoice_to_sap():
         # Post to SAP B1 Drafts endpoint
         try:
             draft_url = f"{sap.base_url}/b1s/v1/Drafts"
-            logging.info(f"Posting to SAP B1 Drafts endpoint: {draft_url}")
-            logging.debug(f"Request body: {request_body}")
+            logger.info("Posting to SAP B1 Drafts endpoint: %s", draft_url)
+            logger.debug("Request body: %s", request_body)
             
             response = sap.session.post(draft_url, json=request_body, timeout=30)
             
@@ -1348,7 +1756,7 @@ def post_invoice_to_sap():
                 
                 db.session.commit()
                 
-                logging.info(f"Successfully posted SO Invoice {document.document_number} to SAP B1 as Draft {draft_doc_num} (DocEntry: {draft_doc_entry})")
+                logger.info("Successfully posted SO Invoice %s to SAP B1 as Draft %s (DocEntry: %s)", document.document_number, draft_doc_num, draft_doc_entry)
                 
                 return jsonify({
                     'success': True,
@@ -1369,7 +1777,7 @@ def post_invoice_to_sap():
                 except:
                     error_message += ": Unable to parse error response"
                 
-                logging.error(f"SAP B1 posting failed: {error_message}. Response: {response.text[:500]}")
+                logger.error("SAP B1 posting failed: %s. Response: %s", error_message, response.text[:500])
                 
                 document.status = 'failed'
                 document.posting_error = error_message
@@ -1384,7 +1792,7 @@ def post_invoice_to_sap():
             # Sanitize error message for client
             error_message = "SAP B1 connection or posting error occurred"
             full_error = f"SAP B1 posting error: {str(sap_error)}"
-            logging.error(full_error)
+            logger.error(full_error)
             
             document.status = 'failed'
             document.posting_error = full_error
@@ -1397,7 +1805,7 @@ def post_invoice_to_sap():
 
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Error in post_invoice_to_sap API: {str(e)}")
+        logger.error("Error in post_invoice_to_sap API: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
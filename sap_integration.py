@@ -2,13 +2,19 @@ import requests
 import json
 import logging
 import os
+import time
 from datetime import datetime
+from functools import lru_cache
 import urllib.parse
 import urllib3
+from requests.adapters import HTTPAdapter
 from flask import jsonify
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Keep-alive connections held open to the Service Layer per process
+SAP_HTTP_POOL_SIZE = 20
+
 
 class SAPIntegration:
 
@@ -22,8 +28,13 @@ class SAPIntegration:
         self.password = get_credential(credentials, 'SAP_B1_PASSWORD', '')
         self.company_db = get_credential(credentials, 'SAP_B1_COMPANY_DB', '')
         self.session_id = None
+        self.session_expires_at = 0
         self.session = requests.Session()
         self.session.verify = False  # For development, in production use proper SSL
+        adapter = HTTPAdapter(pool_connections=SAP_HTTP_POOL_SIZE, pool_maxsize=SAP_HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.hooks['response'].append(self._on_response)
         self.is_offline = False
 
         # Cache for frequently accessed data
@@ -54,7 +65,10 @@ class SAPIntegration:
                                          json=login_data,
                                          timeout=30)
             if response.status_code == 200:
-                self.session_id = response.json().get('SessionId')
+                login_info = response.json()
+                self.session_id = login_info.get('SessionId')
+                # SessionTimeout is in minutes; renew a minute early
+                self.session_expires_at = time.monotonic() + (login_info.get('SessionTimeout', 30) - 1) * 60
                 logging.info("Successfully logged in to SAP B1")
                 return True
             else:
@@ -68,9 +82,14 @@ class SAPIntegration:
             self.is_offline = True
             return False
 
+    def _on_response(self, response, *args, **kwargs):
+        """Forget an expired session so the next ensure_logged_in logs in again"""
+        if response.status_code == 401:
+            self.session_id = None
+
     def ensure_logged_in(self):
         """Ensure we have a valid session"""
-        if not self.session_id:
+        if not self.session_id or time.monotonic() >= self.session_expires_at:
             return self.login()
         return True
 
@@ -3292,3 +3311,9 @@ class SAPIntegration:
 
 # Create global SAP integration instance for backward compatibility
 sap_b1 = SAPIntegration()
+
+
+@lru_cache(maxsize=1)
+def get_sap():
+    """Process-wide SAPIntegration so the login cookie and keep-alive connections are reused"""
+    return SAPIntegration()